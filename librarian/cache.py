@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+'''Persistent caching of information retrieved from remote databases'''
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import tempfile
+import contextlib
+
+from .utils import download
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_TTL = 7 * 24 * 60 * 60 #one week, in seconds
+
+
+def cache_dir(*parts):
+  '''Returns the path to a (sub-)directory of the librarian cache
+
+  The cache is placed under ``$XDG_CACHE_HOME/librarian`` or, if that variable
+  is not set, under ``~/.cache/librarian``. Directories are created on demand.
+
+
+  Parameters:
+
+    parts (str): Sub-directories to append to the base cache directory
+
+
+  Returns:
+
+    str: The full path to the requested cache directory
+
+  '''
+
+  base = os.environ.get('XDG_CACHE_HOME',
+      os.path.join(os.path.expanduser('~'), '.cache'))
+  path = os.path.join(base, 'librarian', *parts)
+  os.makedirs(path, exist_ok=True)
+  return path
+
+
+def make_key(*parts):
+  '''Builds a cache key out of the string representation of its parts'''
+
+  data = '|'.join(str(k) for k in parts).encode('utf-8')
+  return hashlib.sha1(data).hexdigest()
+
+
+def cached_download(url, key=None, subdir='images'):
+  '''Downloads the contents of a URL, keeping a copy on the local cache
+
+  Contents are stored in a file named after the SHA-1 digest of ``key``, so
+  subsequent calls with the same key are served from disk.
+
+
+  Parameters:
+
+    url (str): The URL to download
+
+    key (:py:class:`str`, optional): The key identifying the contents. If not
+      set, use the URL itself
+
+    subdir (:py:class:`str`, optional): The cache sub-directory to use
+
+
+  Returns:
+
+    bytes: The contents of the URL
+
+  '''
+
+  name = make_key(url if key is None else key) + os.path.splitext(url)[1]
+  path = os.path.join(cache_dir(subdir), name)
+
+  if os.path.exists(path):
+    logger.debug('Using cached copy of %s at %s', url, path)
+
+  else:
+    # streams into a temporary file first, so readers never see partial
+    # contents and the whole response is never buffered in memory
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(path),
+        delete=False) as f:
+      try:
+        download(url, fileobj=f)
+      except Exception:
+        f.close()
+        os.unlink(f.name)
+        raise
+    os.replace(f.name, path)
+
+  with open(path, 'rb') as f:
+    return f.read()
+
+
+class JSONCache(object):
+  '''A key-value store for JSON-serializable objects, backed by SQLite
+
+  Each entry records the time it was stored. Entries older than ``ttl`` seconds
+  are still returned, but flagged as stale, so callers may decide to refresh
+  them.
+
+
+  Parameters:
+
+    path (str): The full path to the SQLite database file to use
+
+    ttl (:py:class:`int`, optional): The number of seconds after which an
+      entry is considered to be stale
+
+  '''
+
+  def __init__(self, path, ttl=DEFAULT_TTL):
+
+    self.path = path
+    self.ttl = ttl
+    self._execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, ' \
+        'value TEXT NOT NULL, fetched_at REAL NOT NULL)')
+
+
+  def _execute(self, sql, args=()):
+    '''Runs a single statement on a fresh connection, returns all rows'''
+
+    # a new connection per statement keeps this usable from several threads
+    with contextlib.closing(sqlite3.connect(self.path, timeout=10)) as conn:
+      with conn:
+        return conn.execute(sql, args).fetchall()
+
+
+  def get(self, key):
+    '''Retrieves an entry from the cache
+
+
+    Parameters:
+
+      key (str): The key of the entry to retrieve
+
+
+    Returns:
+
+      tuple: The cached value and a boolean indicating if the value is still
+      fresh. If the key is not present, returns ``(None, False)``
+
+    '''
+
+    rows = self._execute('SELECT value, fetched_at FROM cache WHERE key = ?',
+        (key,))
+    if not rows: return None, False
+    value, fetched_at = rows[0]
+    return json.loads(value), (time.time() - fetched_at) < self.ttl
+
+
+  def set(self, key, value):
+    '''Stores (or replaces) an entry in the cache'''
+
+    self._execute('INSERT OR REPLACE INTO cache (key, value, fetched_at) ' \
+        'VALUES (?, ?, ?)', (key, json.dumps(value), time.time()))
@@ -7,7 +7,7 @@
 import os
 import re
 import sys
-import six
+import codecs
 import tqdm
 import pexpect
 import subprocess
@@ -377,19 +377,41 @@ def _plan_audio(streams, languages, ios_audio, preserve_all, mapping):
 
 
 def detect_srt_encoding(fname):
-  '''Tries to detect the most pertinent encoding for the input SRT file'''
+  '''Tries to detect the most pertinent encoding for the input SRT file
+
+  Files with a UTF-8 byte-order mark or that decode cleanly as UTF-8 are
+  reported as such, without running :py:mod:`chardet`, which is slow. Other
+  files are handed to :py:mod:`chardet`. Windows-1252 is only assumed if
+  :py:mod:`chardet` cannot decide and the contents decode with it. Empty files
+  have no encoding (``None``).
+  '''
 
   translator_matrix = {
       'UTF-8-SIG': 'UTF-8',
       }
 
   with open(fname, 'rb') as f:
-    ret = chardet.detect(f.read())
-    if ret['encoding'] is not None:
-      ret = ret['encoding'].upper()
-      return translator_matrix.get(ret, ret)
+    raw = f.read()
+
+  if not raw: return None
+  if raw.startswith(codecs.BOM_UTF8): return 'UTF-8'
 
-  return None
+  try:
+    raw.decode('UTF-8')
+    return 'UTF-8'
+  except UnicodeDecodeError:
+    pass
+
+  ret = chardet.detect(raw)
+  if ret['encoding'] is not None:
+    ret = ret['encoding'].upper()
+    return translator_matrix.get(ret, ret)
+
+  try:
+    raw.decode('WINDOWS-1252')
+    return 'WINDOWS-1252'
+  except UnicodeDecodeError:
+    return None
 
 
 def _plan_subtitles(streams, filename, languages, mapping, show,
@@ -596,7 +618,7 @@ def print_plan(plan):
   '''
 
   def _sorter(k):
-    if isinstance(k[0], six.string_types):
+    if isinstance(k[0], str):
       return k[1]['index']
     return int(k[0].attrib['index'])
 
@@ -608,7 +630,7 @@ def print_plan(plan):
             _get_stream_language(k).alpha3b, k.attrib['codec_name']))
       continue
 
-    if isinstance(k, six.string_types):
+    if isinstance(k, str):
       # either it is an __ios__ stream or an external sub
       if k == '__ios__':
         print('  %s stream [%s] lang=%s codec=%s -> [%d] codec=%s (iOS)' % \
@@ -659,15 +681,17 @@ def options(infile, outfile, planning, threads=0):
 
   '''
 
+  caps = {}
+
   def _audio_codec(index, channels):
     '''Chooses fdk-aac if available, otherwise stock aac'''
 
-    caps = ffmpeg_codec_capabilities()
+    if not caps: caps.update(ffmpeg_codec_capabilities()) #probe only once
     if 'libfdk_aac' in caps['aac']['description']:
-      return ['libfdk_aac', '-vbr', '4']
+      return ('libfdk_aac', '-vbr', '4')
     else: #use default
       bitrate = channels * 64
-      return ['aac', '-b:%d' % index, '%dk' % bitrate]
+      return ('aac', '-b:%d' % index, '%dk' % bitrate)
 
   # organizes the input stream by index
   keeping = [(k,v) for k,v in planning.items() if v]
@@ -679,81 +703,80 @@ def options(infile, outfile, planning, threads=0):
   extsubcnt = 1 #external subtitle stream count
   for k,v in sorted_planning:
 
-    if isinstance(k, six.string_types):
+    if isinstance(k, str):
 
       if k == '__ios__': #secondary iOS stream, converted from another one
-        mapopt += ['-map', '[iOS]']
-        codopt += [
+        mapopt.extend(('-map', '[iOS]'))
+        codopt.extend((
             '-disposition:%d' % v['index'],
             v['disposition'],
             '-codec:%d' % v['index'],
-            ] + \
-            _audio_codec(v['index'], 2) + \
-            [
-                # converting from surround (5.1) - this formula comes from:
-                # http://atsc.org/wp-content/uploads/2015/03/A52-201212-17.pdf
-                '-filter_complex', '[0:%s]pan=stereo|FL<1.0*FL+0.707*FC+' \
-                '0.707*BL|FR<1.0*FR+0.707*FC+0.707*BR[iOS]' % \
-                v['original'].attrib['index'],
-                '-metadata:s:%d' % v['index'],
-            ]
+            ))
+        codopt.extend(_audio_codec(v['index'], 2))
+        codopt.extend((
+            # converting from surround (5.1) - this formula comes from:
+            # http://atsc.org/wp-content/uploads/2015/03/A52-201212-17.pdf
+            '-filter_complex', '[0:%s]pan=stereo|FL<1.0*FL+0.707*FC+' \
+            '0.707*BL|FR<1.0*FR+0.707*FC+0.707*BR[iOS]' % \
+            v['original'].attrib['index'],
+            '-metadata:s:%d' % v['index'],
+            ))
         if 'language' in v:
-          codopt += ['language=%s' % v['language'].alpha3b]
+          codopt.append('language=%s' % v['language'].alpha3b)
         else:
-          codopt += [
-              'language=%s' % _get_stream_language(v['original']).alpha3b
-              ]
+          codopt.append(
+              'language=%s' % _get_stream_language(v['original']).alpha3b)
 
       else: #subtitle SRT to bring in
         if v['encoding'] is not None:
-          inopt += ['-sub_charenc', v['encoding']]
-        inopt += ['-i', k]
-        mapopt += ['-map', str(extsubcnt) + ':0']
+          inopt.extend(('-sub_charenc', v['encoding']))
+        inopt.extend(('-i', k))
+        mapopt.extend(('-map', '%d:0' % extsubcnt))
         extsubcnt += 1
-        codopt += [
+        codopt.extend((
             '-disposition:%d' % v['index'], v['disposition'],
             '-codec:%d' % v['index'],
             'mov_text',
             '-metadata:s:%d' % v['index'],
             'language=%s' % v['language'].alpha3b,
-            ]
+            ))
 
     else: # normal stream to be moved or transcoded
 
-      mapopt += ['-map', '0:%s' % k.attrib['index']]
-      codopt += [
+      mapopt.extend(('-map', '0:%s' % k.attrib['index']))
+      codopt.extend((
           '-disposition:%d' % v['index'], v['disposition'],
           '-codec:%d' % v['index'],
-          ]
+          ))
       kind = k.attrib['codec_type']
 
       if v['codec'] == 'copy':
-        codopt += ['copy']
+        codopt.append('copy')
       else: #some transcoding
         if kind == 'video':
-          codopt += ['libx264', '-preset', 'slower', '-crf', '21']
+          codopt.extend(('libx264', '-preset', 'slower', '-crf', '21'))
         elif kind == 'audio':
-          codopt += _audio_codec(v['index'], int(k.attrib['channels']))
+          codopt.extend(_audio_codec(v['index'], int(k.attrib['channels'])))
         elif kind == 'subtitle':
-          codopt += ['mov_text']
+          codopt.append('mov_text')
 
       if kind in ('audio', 'subtitle'): #add language
-        codopt += [
-            '-metadata:s:%d' % v['index'],
-            ]
         if 'language' in v:
-          codopt += ['language=%s' % v['language'].alpha3b]
+          lang = v['language'].alpha3b
         else:
-          codopt += ['language=%s' % _get_stream_language(k).alpha3b]
+          lang = _get_stream_language(k).alpha3b
+        codopt.extend(('-metadata:s:%d' % v['index'], 'language=%s' % lang))
 
   # replaces qtfaststart need
-  codopt += ['-movflags', '+faststart']
-
-  fix_sub_duration = ['-fix_sub_duration']
+  codopt.extend(('-movflags', '+faststart'))
 
   # now we create the mapping specification
-  return ['-threads', str(threads)] + fix_sub_duration + \
-      ['-i', infile] + inopt + mapopt + codopt + [outfile]
+  retval = ['-threads', str(threads), '-fix_sub_duration', '-i', infile]
+  retval.extend(inopt)
+  retval.extend(mapopt)
+  retval.extend(codopt)
+  retval.append(outfile)
+  return retval
 
 
 def run(options, progress=0):
@@ -0,0 +1,19 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+'''Command-line applications'''
+
+
+def package_version():
+  '''Returns the version of the installed librarian package
+
+  Uses :py:mod:`importlib.metadata`, which is much cheaper to import than
+  ``pkg_resources``. The latter is only used on Python versions older than 3.8.
+  '''
+
+  try:
+    from importlib.metadata import version
+  except ImportError: #python < 3.8
+    import pkg_resources
+    return pkg_resources.require('librarian')[0].version
+  return version('librarian')
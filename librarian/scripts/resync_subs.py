@@ -61,11 +61,11 @@ def main(user_input=None):
     argv = sys.argv[1:]
 
   import docopt
-  import pkg_resources
+  from . import package_version
 
   completions = dict(
       prog=os.path.basename(sys.argv[0]),
-      version=pkg_resources.require('librarian')[0].version
+      version=package_version()
       )
 
   args = docopt.docopt(
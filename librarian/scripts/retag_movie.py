@@ -4,7 +4,7 @@
 """Re-tag an MP4 video with information from TMDB
 
 Usage: %(prog)s [-v...] [--query=<query>] [--apikey=<key>] [--dry-run]
-                [--basename-only] <file>
+                [--basename-only] [--no-cache] <file>
        %(prog)s --help
        %(prog)s --version
 
@@ -32,6 +32,9 @@ Options:
                        movie title from the filename. If you set this flag,
                        then only the basename of the file will be considered.
                        Otherwise, the full path
+  --no-cache           If set, always contact TMDB instead of using locally
+                       cached movie information. The local cache is refreshed
+                       with the retrieved information
 
 
 Examples:
@@ -59,11 +62,11 @@ def main(user_input=None):
     argv = sys.argv[1:]
 
   import docopt
-  import pkg_resources
+  from . import package_version
 
   completions = dict(
       prog=os.path.basename(sys.argv[0]),
-      version=pkg_resources.require('librarian')[0].version
+      version=package_version()
       )
 
   args = docopt.docopt(
@@ -86,11 +89,12 @@ def main(user_input=None):
     if info['type'] == 'episode':
       raise RuntimeError('File %s was guessed as a TV show episode - " \
           "you may pass the --query="title" with the right title to fix it')
-    movie = record_from_guess(info)
+    movie = record_from_guess(info, use_cache=not args['--no-cache'])
 
   else:
     from ..tmdb import record_from_query
-    movie = record_from_query(args['--query'])
+    movie = record_from_query(args['--query'],
+        use_cache=not args['--no-cache'])
 
   # printout some information about the movie
   if movie is None:
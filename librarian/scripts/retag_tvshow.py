@@ -4,7 +4,8 @@
 """Re-tag an MP4 video with information from TMDB
 
 Usage: %(prog)s [-v...] [--name=<name>] [--apikey=<key>] [--dry-run]
-                [--basename-only] [--season=<int>] [--episode=<int>] <file>
+                [--basename-only] [--season=<int>] [--episode=<int>]
+                [--no-cache] <file>
        %(prog)s --help
        %(prog)s --version
 
@@ -36,6 +37,9 @@ Options:
   -a, --apikey=<key>   If provided, then use this key instead of searching for
                        one in the environment (TVDB_APIKEY), your current
                        working directory or your home directory (.librarianrc)
+  --no-cache           If set, always search TVDB for the show instead of
+                       using its locally cached identifier. The local cache is
+                       refreshed with the search result
 
 
 Examples:
@@ -68,11 +72,11 @@ def main(user_input=None):
     argv = sys.argv[1:]
 
   import docopt
-  import pkg_resources
+  from . import package_version
 
   completions = dict(
       prog=os.path.basename(sys.argv[0]),
-      version=pkg_resources.require('librarian')[0].version
+      version=package_version()
       )
 
   args = docopt.docopt(
@@ -105,7 +109,7 @@ def main(user_input=None):
   info['type'] == 'episode' #force
 
   from ..tvdb import record_from_guess
-  episode = record_from_guess(info)
+  episode = record_from_guess(info, use_cache=not args['--no-cache'])
 
   if args['--dry-run']:
     from ..tvdb import pretty_print
@@ -5,12 +5,12 @@
 
 
 import os
+import io
 import logging
 import subliminal
 import babelfish
 import chardet
 import pysrt
-import six
 
 from .utils import load_config_section
 from .convert import detect_srt_encoding
@@ -83,12 +83,11 @@ def setup_subliminal(user_provided=None):
   if config is None and envkey is not None:
     config = _parse_config_string(envkey)
 
-  if config is None and os.path.exists('.librarianrc'):
-    config = load_config_section('.librarianrc', 'subtitles')
-
-  home_path = os.path.join(os.environ['HOME'], '.librarianrc')
-  if config is None and os.path.exists(home_path):
-    config = var_from_config(home_path, 'subtitles')
+  # missing files are ignored, parsed ones are shared with setup_apikey()
+  home_path = os.path.expanduser(os.path.join('~', '.librarianrc'))
+  for path in ('.librarianrc', home_path):
+    if config is not None: break
+    config = load_config_section(path, 'subtitles')
 
   def _associate(config):
     '''Associate config parameters with provider names'''
@@ -152,11 +151,12 @@ def search(filename, languages, config, providers=None):
 
   video = _get_video(filename)
 
-  # call APIs once
+  # call APIs once, querying all providers concurrently
   logger.info('Contacting subtitle providers...')
   subtitles = subliminal.list_subtitles([video], set(languages),
-      subliminal.core.ProviderPool, providers=providers,
-      provider_configs=config)
+      subliminal.core.AsyncProviderPool,
+      max_workers=len(providers) if providers else None,
+      providers=providers, provider_configs=config)
 
   def _score(st):
     try:
@@ -271,7 +271,7 @@ def download(filename, results, languages, config, providers=None):
       # if everything checks, re-write subtitles in utf-8
       srt.clean_indexes()
       srt.eol = os.linesep
-      buf = six.StringIO()
+      buf = io.StringIO()
       srt.write_into(buf)
       s.content = buf.getvalue().encode(encoding='UTF-8')
       s.encoding = 'utf-8'
@@ -323,6 +323,84 @@ def download(filename, results, languages, config, providers=None):
   subliminal.save_subtitles(video, to_download, encoding='UTF-8')
 
 
+def _srt_time_to_ms(t):
+  '''Converts an SRT timestamp (``hh:mm:ss,MMM``) into milliseconds'''
+
+  h, m, s = t.split(':')
+  s, ms = s.replace('.', ',').split(',')
+  return ((int(h) * 60 + int(m)) * 60 + int(s)) * 1000 + int(ms)
+
+
+def _parse_srt_fast(text):
+  '''Parses the contents of an SRT file without using regular expressions
+
+  Subtitles are separated by blank lines (or lines containing only
+  whitespace). On each block, the first line is the subtitle index, the second
+  one carries the timings (separated by ``-->``), optionally followed by
+  positioning information, and the remaining ones, the text. Blocks that cannot
+  be parsed are skipped.
+
+
+  Parameters:
+
+    text (str): The (decoded) contents of the SRT file
+
+
+  Returns:
+
+    list: A list of tuples ``(index, start, end, position, text)`` where
+    ``start`` and ``end`` are expressed in milliseconds and ``position`` is
+    whatever follows the end time on the timings line (or an empty string)
+
+  '''
+
+  def _parse_block(lines):
+    if len(lines) < 2: return None
+    pos = lines[1].find('-->')
+    if pos < 0: return None
+    try:
+      index = int(lines[0])
+      start = _srt_time_to_ms(lines[1][:pos].strip())
+      end = lines[1][pos+3:].split(None, 1)
+      position = end[1].strip() if len(end) > 1 else ''
+      end = _srt_time_to_ms(end[0])
+    except (ValueError, IndexError):
+      return None
+    return (index, start, end, position, '\n'.join(lines[2:]))
+
+  retval = []
+  block = []
+  text = text.lstrip('\ufeff').replace('\r\n', '\n').replace('\r', '\n')
+
+  for line in text.split('\n') + ['']: #sentinel flushes the last block
+    if line.strip():
+      block.append(line)
+      continue
+    if not block: continue
+    item = _parse_block(block)
+    if item is None:
+      logger.debug('Skipping unparseable subtitle block %r', '\n'.join(block))
+    else:
+      retval.append(item)
+    block = []
+
+  return retval
+
+
+def _load_srt(fname):
+  '''Loads an SRT file into a :py:class:`pysrt.SubRipFile`'''
+
+  encoding = detect_srt_encoding(fname) or 'UTF-8'
+  with open(fname, 'rb') as f:
+    text = f.read().decode(encoding)
+
+  items = [pysrt.SubRipItem(index, pysrt.SubRipTime.from_ordinal(start),
+    pysrt.SubRipTime.from_ordinal(end), txt, position) for index, start, end,
+    position, txt in _parse_srt_fast(text)]
+
+  return pysrt.SubRipFile(items=items, path=fname, encoding=encoding)
+
+
 def resync_subtitles(fname, start_frame, start_time, end_frame, end_time):
   '''Edits an SRT file to time shift subtitles
 
@@ -394,7 +472,7 @@ def resync_subtitles(fname, start_frame, start_time, end_frame, end_time):
   end_time   = pysrt.SubRipTime.coerce(end_time)
   assert start_time < end_time
 
-  f = pysrt.open(fname, encoding=detect_srt_encoding(fname))
+  f = _load_srt(fname)
 
   # organize subtitles by index
   indexed = dict([(k.index, k) for k in f])
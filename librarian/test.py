@@ -5,18 +5,27 @@
 
 import os
 import sys
-import six
 import shutil
 import tempfile
+import time
 import datetime
+import threading
+import functools
 import contextlib
-import pkg_resources
 from xml.etree import ElementTree
 import nose.tools
 from mutagen import mp4
 import pysrt
 
-from . import tmdb, tvdb, utils, convert, subtitles
+from . import tmdb, tvdb, utils, convert, subtitles, cache
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+_DATA = os.path.join(_HERE, 'data')
+
+
+@functools.lru_cache(maxsize=1)
+def _movie_mp4_bytes():
+  with open(os.path.join(_DATA, 'movie.mp4'), 'rb') as f: return f.read()
 
 
 def setup_apikeys():
@@ -33,6 +42,31 @@ def diverge_stdout_to_null():
   sys.stdout = buf #re-stores stdout
 
 
+@contextlib.contextmanager
+def temporary_cache_home():
+  tmpdir = tempfile.mkdtemp()
+  saved = os.environ.get('XDG_CACHE_HOME')
+  saved_caches = (tmdb._record_cache, tvdb._search_cache)
+  os.environ['XDG_CACHE_HOME'] = tmpdir
+  tmdb._record_cache = tvdb._search_cache = None #re-opened under tmpdir
+  try:
+    yield tmpdir
+  finally:
+    if saved is None: del os.environ['XDG_CACHE_HOME']
+    else: os.environ['XDG_CACHE_HOME'] = saved
+    tmdb._record_cache, tvdb._search_cache = saved_caches
+    shutil.rmtree(tmpdir)
+
+
+def without_user_cache(f):
+  '''Runs a test on an empty, temporary cache, instead of the user's one'''
+
+  @functools.wraps(f)
+  def wrapper(*args, **kwargs):
+    with temporary_cache_home(): return f(*args, **kwargs)
+  return wrapper
+
+
 def test_guess_movie_onlyname():
 
   info = utils.guess('/Volumes/My Movies/Star Wars: Rogue One (2016).mp4',
@@ -76,7 +110,17 @@ def test_guess_tv_show_fullpath():
   nose.tools.eq_(info['type'], 'episode')
 
 
+def test_quick_container():
+
+  nose.tools.eq_(utils.quick_container('/Volumes/Movies/movie.MP4'), 'mp4')
+  nose.tools.eq_(utils.quick_container('friends.s01e01.mkv'), 'mkv')
+  nose.tools.eq_(utils.quick_container('friends.s01e01.en.srt'), None)
+  assert utils.is_video('friends.s01e01.mkv')
+  assert not utils.is_video('friends.s01e01.en.srt')
+
+
 @nose.tools.with_setup(setup_apikeys)
+@without_user_cache
 def test_tmdb_from_query():
 
   movie = tmdb.record_from_query('Star Wars Episode II')
@@ -88,6 +132,7 @@ def test_tmdb_from_query():
 
 
 @nose.tools.with_setup(setup_apikeys)
+@without_user_cache
 def test_tvdb_from_query():
 
   episode = tvdb.record_from_query('Friends', 1, 1)
@@ -113,6 +158,7 @@ def test_tvdb_from_query():
 
 
 @nose.tools.with_setup(setup_apikeys)
+@without_user_cache
 def test_tmdb_from_guess():
 
   info = utils.guess('/Volumes/My Movies/Star Wars: Rogue One (2016).mp4',
@@ -126,6 +172,7 @@ def test_tmdb_from_guess():
 
 
 @nose.tools.with_setup(setup_apikeys)
+@without_user_cache
 def test_tvdb_from_guess():
 
   info = utils.guess('/Volumes/My TV Shows/friends.s01e01.the_one_where_monica_gets_a_roommate.mkv', fullpath=False)
@@ -153,13 +200,12 @@ def test_tvdb_from_guess():
 
 
 @nose.tools.with_setup(setup_apikeys)
+@without_user_cache
 def test_mp4_movie_tagging():
 
   movie = tmdb.record_from_query('Star Wars Episode II')
-  filename = pkg_resources.resource_filename(__name__,
-      os.path.join('data', 'movie.mp4'))
   with tempfile.NamedTemporaryFile() as tmp:
-    with open(filename, 'rb') as original: tmp.write(original.read())
+    tmp.write(_movie_mp4_bytes())
     tmp.flush()
     tmp.seek(0)
     tmdb.retag(tmp.name, movie)
@@ -188,27 +234,178 @@ def test_mp4_movie_tagging():
 
 
 @nose.tools.with_setup(setup_apikeys)
+@without_user_cache
 def test_mp4_movie_pretty_printing():
 
   movie = tmdb.record_from_query('Star Wars Episode II')
-  filename = pkg_resources.resource_filename(__name__,
-      os.path.join('data', 'movie.mp4'))
   with tempfile.NamedTemporaryFile() as tmp:
-    with open(filename, 'rb') as original: tmp.write(original.read())
+    tmp.write(_movie_mp4_bytes())
     tmp.flush()
     tmp.seek(0)
     with diverge_stdout_to_null():
       tmdb.pretty_print(tmp.name, movie)
 
 
+def _stub_movie(**kwargs):
+  '''A movie record, as restored from the local cache, without a poster'''
+
+  data = dict(
+      id=1,
+      title='Stub Movie',
+      tagline='A tagline',
+      overview='An overview',
+      release_date='2002-05-16',
+      genres=[{'name': 'Adventure'}, {'name': 'Science Fiction'}],
+      cast=[{'name': 'Actor %d' % k} for k in range(7)],
+      crew=[
+        {'name': 'A Writer', 'department': 'Writing'},
+        {'name': 'A Director', 'department': 'Directing'},
+        {'name': 'A Sound Engineer', 'department': 'Sound'},
+        ],
+      countries=[{'iso_3166_1': 'US', 'certification': 'PG'}],
+      )
+  data.update(kwargs)
+  return tmdb.CachedMovie(data)
+
+
+def test_tmdb_from_queries_cached():
+
+  tmpdir = tempfile.mkdtemp()
+  saved = tmdb._record_cache
+  try:
+    tmdb._record_cache = cache.JSONCache(os.path.join(tmpdir, 'r.sqlite'))
+    for title, year in (('First', None), ('Second', 2002)):
+      data = _stub_movie(title=title, poster_path='/poster.jpg').__dict__
+      tmdb._record_cache.set(cache.make_key(title, year), data)
+
+    threads = threading.active_count()
+    movies = tmdb.record_from_queries(['First', 'Second'], [None, 2002],
+        max_workers=2)
+    nose.tools.eq_([k.title for k in movies], ['First', 'Second'])
+    nose.tools.eq_(threading.active_count(), threads) #no stray downloads
+
+  finally:
+    tmdb._record_cache = saved
+    shutil.rmtree(tmpdir)
+
+
+def test_tmdb_from_queries_stale():
+
+  tmpdir = tempfile.mkdtemp()
+  saved = (tmdb._record_cache, tmdb._download_record)
+  lock = threading.Lock()
+  running = [0, 0] #current, peak
+
+  def _download(query, year):
+    with lock:
+      running[0] += 1
+      running[1] = max(running)
+    time.sleep(0.05)
+    with lock: running[0] -= 1
+    data = _stub_movie(title=query + ' (refreshed)').__dict__
+    return tmdb.CachedMovie(data), data
+
+  try:
+    tmdb._record_cache = cache.JSONCache(os.path.join(tmpdir, 'r.sqlite'),
+        ttl=0) #every entry is stale
+    tmdb._download_record = _download
+    queries = ['Movie %d' % k for k in range(10)]
+    for k in queries:
+      tmdb._record_cache.set(cache.make_key(k, None), _stub_movie().__dict__)
+
+    threads = threading.active_count()
+    movies = tmdb.record_from_queries(queries, max_workers=2)
+    nose.tools.eq_([k.title for k in movies],
+        [k + ' (refreshed)' for k in queries])
+    nose.tools.eq_(running[1], 2) #never above max_workers
+    nose.tools.eq_(threading.active_count(), threads)
+
+  finally:
+    tmdb._record_cache, tmdb._download_record = saved
+    shutil.rmtree(tmpdir)
+
+
+def test_tmdb_unusable_cache():
+
+  saved = (tmdb._record_cache, tmdb._download_record, tvdb._search_cache)
+
+  def _download(query, year):
+    data = _stub_movie(title=query).__dict__
+    return tmdb.CachedMovie(data), data
+
+  try:
+    tmdb._download_record = _download
+    with temporary_cache_home() as home:
+
+      # the cache directory cannot be created
+      os.environ['XDG_CACHE_HOME'] = os.path.join(home, 'file')
+      with open(os.environ['XDG_CACHE_HOME'], 'wb') as f: f.write(b'')
+      tmdb._record_cache = tvdb._search_cache = None
+      nose.tools.eq_(tmdb.record_from_query('Missing').title, 'Missing')
+      nose.tools.eq_(tvdb._cache_get('key'), (None, False))
+      tvdb._cache_set('key', 1) #ignored
+
+      # the cache database is corrupt
+      os.environ['XDG_CACHE_HOME'] = home
+      path = os.path.join(cache.cache_dir('tmdb'), 'records.sqlite')
+      with open(path, 'wb') as f: f.write(b'not a database' * 100)
+      tmdb._record_cache = None
+      nose.tools.eq_(tmdb.record_from_query('Corrupt').title, 'Corrupt')
+
+  finally:
+    tmdb._record_cache, tmdb._download_record, tvdb._search_cache = saved
+
+
+def test_mp4_movie_tagging_offline():
+
+  movie = _stub_movie()
+  plan = tmdb._tag_plan(movie)
+  nose.tools.eq_(plan.genres, ['Adventure', 'Science Fiction'])
+  nose.tools.eq_(plan.certification, b'mpaa|PG|200|')
+  nose.tools.eq_(plan.image_url, None)
+  xml = ElementTree.fromstring(plan.plist)
+  names = [k.text for k in xml.iter('string')]
+  nose.tools.eq_(names, ['Actor %d' % k for k in range(5)] + \
+      ['A Writer', 'A Director'])
+  assert tmdb._tag_plan(movie) is plan #computed once
+
+  with tempfile.NamedTemporaryFile(suffix='.mp4') as tmp:
+    tmp.write(_movie_mp4_bytes())
+    tmp.flush()
+    tmdb.retag(tmp.name, movie)
+    rewritten = mp4.MP4(tmp.name)
+    nose.tools.eq_(rewritten.tags['\xa9nam'], ['Stub Movie'])
+    nose.tools.eq_(rewritten.tags['desc'], ['A tagline'])
+    nose.tools.eq_(rewritten.tags['stik'], [9])
+    nose.tools.eq_(rewritten.tags['hdvd'], [0])
+    nose.tools.eq_(rewritten.tags['\xa9gen'], plan.genres)
+    nose.tools.eq_(rewritten.tags['----:com.apple.iTunes:iTunMOVI'][0],
+        plan.plist)
+    assert 'covr' not in rewritten.tags
+
+
+def test_mp4_movie_retag_skips_unchanged():
+
+  with tempfile.NamedTemporaryFile(suffix='.mp4') as tmp:
+    tmp.write(_movie_mp4_bytes())
+    tmp.flush()
+    nose.tools.eq_(tmdb.retag(tmp.name, _stub_movie()), True)
+    mtime = os.stat(tmp.name).st_mtime_ns
+    nose.tools.eq_(tmdb.retag(tmp.name, _stub_movie()), False)
+    nose.tools.eq_(os.stat(tmp.name).st_mtime_ns, mtime) #not rewritten
+
+    # a changed record has a different signature: tags are rewritten
+    nose.tools.eq_(tmdb.retag(tmp.name, _stub_movie(title='Other')), True)
+    nose.tools.eq_(mp4.MP4(tmp.name).tags['\xa9nam'], ['Other'])
+
+
 @nose.tools.with_setup(setup_apikeys)
+@without_user_cache
 def test_mp4_episode_tagging():
 
   episode = tvdb.record_from_query('Friends', 1, 1) #season 1, episode 1
-  filename = pkg_resources.resource_filename(__name__,
-      os.path.join('data', 'movie.mp4'))
   with tempfile.NamedTemporaryFile() as tmp:
-    with open(filename, 'rb') as original: tmp.write(original.read())
+    tmp.write(_movie_mp4_bytes())
     tmp.flush()
     tmp.seek(0)
     tvdb.retag(tmp.name, episode)
@@ -250,13 +447,12 @@ def test_mp4_episode_tagging():
 
 
 @nose.tools.with_setup(setup_apikeys)
+@without_user_cache
 def test_mp4_episode_pretty_printing():
 
   episode = tvdb.record_from_query('Friends', 1, 1) #season 1, episode 1
-  filename = pkg_resources.resource_filename(__name__,
-      os.path.join('data', 'movie.mp4'))
   with tempfile.NamedTemporaryFile() as tmp:
-    with open(filename, 'rb') as original: tmp.write(original.read())
+    tmp.write(_movie_mp4_bytes())
     tmp.flush()
     tmp.seek(0)
     with diverge_stdout_to_null():
@@ -265,8 +461,7 @@ def test_mp4_episode_pretty_printing():
 
 def test_ffprobe():
 
-  filename = pkg_resources.resource_filename(__name__,
-      os.path.join('data', 'movie.mp4'))
+  filename = os.path.join(_DATA, 'movie.mp4')
 
   data = convert.probe(filename)
 
@@ -373,8 +568,7 @@ def test_planning_mkv_1():
   # Stream[3] - subtitle, subrip codec, language = und, default
   # External: movie.eng.srt alongside
 
-  filename = pkg_resources.resource_filename(__name__,
-      os.path.join('data', 'mkv_1', 'probe.xml'))
+  filename = os.path.join(_DATA, 'mkv_1', 'probe.xml')
 
   # given an input file in MKV format and external SRT files, plans for MP4
   # transcoding
@@ -382,8 +576,7 @@ def test_planning_mkv_1():
     probe = ElementTree.fromstring(f.read())
 
   # adjust filename as we don't know where we're installed
-  moviefile = pkg_resources.resource_filename(__name__,
-      os.path.join('data', 'mkv_1', 'movie.mkv'))
+  moviefile = os.path.join(_DATA, 'mkv_1', 'movie.mkv')
   probe.find('format').attrib['filename'] = moviefile
 
   languages = [utils.as_language(k) for k in ['en-gb', 'fra']]
@@ -431,7 +624,7 @@ def test_planning_mkv_1():
 
   # the 4th stream should be an external SRT subtitle in english
   subt, opts = sorted_planning[3]
-  assert isinstance(subt, six.string_types)
+  assert isinstance(subt, str)
   assert subt.endswith('en-GB.srt')
   nose.tools.eq_(opts['index'], 3)
   nose.tools.eq_(opts['codec'], 'mov_text')
@@ -451,8 +644,7 @@ def test_planning_mkv_2():
   # External: movie.eng.srt alongside
   # External: movie.fre.srt alongside
 
-  filename = pkg_resources.resource_filename(__name__,
-      os.path.join('data', 'mkv_2', 'probe.xml'))
+  filename = os.path.join(_DATA, 'mkv_2', 'probe.xml')
 
   # given an input file in MKV format and external SRT files, plans for MP4
   # transcoding
@@ -460,8 +652,7 @@ def test_planning_mkv_2():
     probe = ElementTree.fromstring(f.read())
 
   # adjust filename as we don't know where we're installed
-  moviefile = pkg_resources.resource_filename(__name__,
-      os.path.join('data', 'mkv_2', 'movie.mkv'))
+  moviefile = os.path.join(_DATA, 'mkv_2', 'movie.mkv')
   probe.find('format').attrib['filename'] = moviefile
 
   languages = [utils.as_language(k) for k in ['eng', 'fra']]
@@ -511,7 +702,7 @@ def test_planning_mkv_2():
 
   # the 5th stream should be an external SRT subtitle in english
   subt, opts = sorted_planning[4]
-  assert isinstance(subt, six.string_types)
+  assert isinstance(subt, str)
   nose.tools.eq_(opts['index'], 4)
   nose.tools.eq_(opts['codec'], 'mov_text')
   nose.tools.eq_(opts['language'], languages[0])
@@ -560,8 +751,7 @@ def test_planning_mkv_3():
   # Stream[28] - subtitle, hdmv_pgs_subtitle codec, language  = nor
   # Stream[29] - subtitle, hdmv_pgs_subtitle codec, language  = swe
 
-  filename = pkg_resources.resource_filename(__name__,
-      os.path.join('data', 'mkv_3', 'probe.xml'))
+  filename = os.path.join(_DATA, 'mkv_3', 'probe.xml')
 
   # given an input file in MKV format and external SRT files, plans for MP4
   # transcoding
@@ -569,8 +759,7 @@ def test_planning_mkv_3():
     probe = ElementTree.fromstring(f.read())
 
   # adjust filename as we don't know where we're installed
-  moviefile = pkg_resources.resource_filename(__name__,
-      os.path.join('data', 'mkv_3', 'movie.mkv'))
+  moviefile = os.path.join(_DATA, 'mkv_3', 'movie.mkv')
   probe.find('format').attrib['filename'] = moviefile
 
   languages = [utils.as_language(k) for k in ['eng', 'por', 'fre']]
@@ -646,8 +835,7 @@ def test_planning_mkv_3b():
   # Stream[28] - subtitle, hdmv_pgs_subtitle codec, language  = nor
   # Stream[29] - subtitle, hdmv_pgs_subtitle codec, language  = swe
 
-  filename = pkg_resources.resource_filename(__name__,
-      os.path.join('data', 'mkv_3', 'probe.xml'))
+  filename = os.path.join(_DATA, 'mkv_3', 'probe.xml')
 
   # given an input file in MKV format and external SRT files, plans for MP4
   # transcoding
@@ -655,8 +843,7 @@ def test_planning_mkv_3b():
     probe = ElementTree.fromstring(f.read())
 
   # adjust filename as we don't know where we're installed
-  moviefile = pkg_resources.resource_filename(__name__,
-      os.path.join('data', 'mkv_3', 'movie.mkv'))
+  moviefile = os.path.join(_DATA, 'mkv_3', 'movie.mkv')
   probe.find('format').attrib['filename'] = moviefile
 
   languages = [utils.as_language(k) for k in ['eng', 'por', 'fre']]
@@ -717,8 +904,7 @@ def test_options_mkv_1():
   # Stream[3] - subtitle, subrip codec, language = und, default
   # External: movie.eng.srt alongside
 
-  filename = pkg_resources.resource_filename(__name__,
-      os.path.join('data', 'mkv_1', 'probe.xml'))
+  filename = os.path.join(_DATA, 'mkv_1', 'probe.xml')
 
   # given an input file in MKV format and external SRT files, plans for MP4
   # transcoding
@@ -726,8 +912,7 @@ def test_options_mkv_1():
     probe = ElementTree.fromstring(f.read())
 
   # adjust filename as we don't know where we're installed
-  moviefile = pkg_resources.resource_filename(__name__,
-      os.path.join('data', 'mkv_1', 'movie.mkv'))
+  moviefile = os.path.join(_DATA, 'mkv_1', 'movie.mkv')
   probe.find('format').attrib['filename'] = moviefile
 
   languages = [utils.as_language(k) for k in ['en-GB', 'fra']]
@@ -783,8 +968,7 @@ def test_options_mkv_2():
   # External: movie.eng.srt alongside
   # External: movie.fre.srt alongside
 
-  filename = pkg_resources.resource_filename(__name__,
-      os.path.join('data', 'mkv_2', 'probe.xml'))
+  filename = os.path.join(_DATA, 'mkv_2', 'probe.xml')
 
   # given an input file in MKV format and external SRT files, plans for MP4
   # transcoding
@@ -792,8 +976,7 @@ def test_options_mkv_2():
     probe = ElementTree.fromstring(f.read())
 
   # adjust filename as we don't know where we're installed
-  moviefile = pkg_resources.resource_filename(__name__,
-      os.path.join('data', 'mkv_2', 'movie.mkv'))
+  moviefile = os.path.join(_DATA, 'mkv_2', 'movie.mkv')
   probe.find('format').attrib['filename'] = moviefile
 
   languages = [utils.as_language(k) for k in ['eng', 'fra']]
@@ -841,8 +1024,7 @@ def test_options_mkv_2():
 
 def test_run_progress():
 
-  filename = pkg_resources.resource_filename(__name__,
-      os.path.join('data', 'movie.mp4'))
+  filename = os.path.join(_DATA, 'movie.mp4')
   #filename = '/Users/andre/Downloads/SampleVideo_1280x720_30mb.mp4'
 
   probe = convert.probe(filename)
@@ -851,10 +1033,9 @@ def test_run_progress():
   video = _get_default_stream(streams, 'video')
 
   # creates a temporary filename
-  tmpout = tempfile.NamedTemporaryFile(suffix='.mkv')
-  tmpname = tmpout.name
-  del tmpout
-  if os.path.exists(tmpname): os.unlink(tmpname)
+  fd, tmpname = tempfile.mkstemp(suffix='.mkv')
+  os.close(fd)
+  os.unlink(tmpname)
 
   # tests we can run our process spawner and track progress
   options = ['-i', filename, '-acodec', 'copy', '-vcodec', 'ffv1', tmpname]
@@ -865,13 +1046,12 @@ def test_run_progress():
     assert os.path.exists(tmpname)
   finally:
     # always delete temporary file in the end
-    if os.path.exists(tmpname): os.unlink(tmpname)
+    with contextlib.suppress(FileNotFoundError): os.unlink(tmpname)
 
 
 def test_run_no_progress():
 
-  filename = pkg_resources.resource_filename(__name__,
-      os.path.join('data', 'movie.mp4'))
+  filename = os.path.join(_DATA, 'movie.mp4')
   #filename = '/Users/andre/Downloads/SampleVideo_1280x720_30mb.mp4'
 
   probe = convert.probe(filename)
@@ -880,10 +1060,9 @@ def test_run_no_progress():
   video = _get_default_stream(streams, 'video')
 
   # creates a temporary filename
-  tmpout = tempfile.NamedTemporaryFile(suffix='.mkv')
-  tmpname = tmpout.name
-  del tmpout
-  if os.path.exists(tmpname): os.unlink(tmpname)
+  fd, tmpname = tempfile.mkstemp(suffix='.mkv')
+  os.close(fd)
+  os.unlink(tmpname)
 
   # tests we can run our process spawner and track progress
   options = ['-i', filename, '-acodec', 'copy', '-vcodec', 'ffv1', tmpname]
@@ -894,7 +1073,7 @@ def test_run_no_progress():
     assert os.path.exists(tmpname)
   finally:
     # always delete temporary file in the end
-    if os.path.exists(tmpname): os.unlink(tmpname)
+    with contextlib.suppress(FileNotFoundError): os.unlink(tmpname)
 
 
 def check_codec(all_caps, name, ctype):
@@ -957,8 +1136,7 @@ def _compare_srt_times(t1, t2, diff=1):
 
 def test_srt_resync_utf8():
 
-  filename = pkg_resources.resource_filename(__name__,
-      os.path.join('data', 'srt', 'utf-8.srt'))
+  filename = os.path.join(_DATA, 'srt', 'utf-8.srt')
 
   new_start = '00:00:45,367'
   new_end = '01:36:57,900'
@@ -972,8 +1150,7 @@ def test_srt_resync_utf8():
 
 def test_srt_resync_bom_utf8():
 
-  filename = pkg_resources.resource_filename(__name__,
-      os.path.join('data', 'srt', 'bom-utf-8.srt'))
+  filename = os.path.join(_DATA, 'srt', 'bom-utf-8.srt')
 
   new_start = '00:00:13,200'
   new_end = '00:00:38,351'
@@ -987,8 +1164,7 @@ def test_srt_resync_bom_utf8():
 
 def test_srt_resync_windows_1252():
 
-  filename = pkg_resources.resource_filename(__name__,
-      os.path.join('data', 'srt', 'windows-1252.srt'))
+  filename = os.path.join(_DATA, 'srt', 'windows-1252.srt')
 
   new_start = '00:00:45,367'
   new_end = '01:36:57,900'
@@ -998,3 +1174,116 @@ def test_srt_resync_windows_1252():
   _compare_srt_times(result[3].start, new_start)
   nose.tools.eq_(result[1327].index, 1328) #notice: index clearing worked
   _compare_srt_times(result[1327].start, new_end)
+
+
+def test_detect_srt_encoding():
+
+  check = lambda name, enc: nose.tools.eq_(convert.detect_srt_encoding(
+    os.path.join(_DATA, name)), enc)
+  check(os.path.join('srt', 'utf-8.srt'), 'UTF-8')
+  check(os.path.join('srt', 'bom-utf-8.srt'), 'UTF-8')
+  check(os.path.join('srt', 'windows-1252.srt'), 'ISO-8859-1')
+  check(os.path.join('mkv_2', 'movie.en.srt'), None) #empty file
+
+  # non-western 8-bit encodings must not be mistaken for Windows-1252
+  text = '1\n00:00:01,000 --> 00:00:02,000\nПривет, как дела? Это ' \
+      'просто тест субтитров на русском языке.\n\n' * 20
+  with tempfile.NamedTemporaryFile(suffix='.srt') as tmp:
+    tmp.write(text.encode('cp1251'))
+    tmp.flush()
+    nose.tools.eq_(convert.detect_srt_encoding(tmp.name), 'WINDOWS-1251')
+
+
+def test_json_cache():
+
+  with temporary_cache_home():
+    path = os.path.join(cache.cache_dir(), 'test.sqlite')
+    store = cache.JSONCache(path)
+    nose.tools.eq_(store.get('missing'), (None, False))
+
+    store.set('key', {'title': 'Movie', 'genres': ['Drama']})
+    nose.tools.eq_(store.get('key'),
+        ({'title': 'Movie', 'genres': ['Drama']}, True))
+
+    stale = cache.JSONCache(path, ttl=0) #same database, everything is stale
+    nose.tools.eq_(stale.get('key'),
+        ({'title': 'Movie', 'genres': ['Drama']}, False))
+
+    store.set('key', 'replaced')
+    nose.tools.eq_(store.get('key'), ('replaced', True))
+
+
+def test_cached_download():
+
+  with temporary_cache_home():
+    subdir = cache.cache_dir('images')
+
+    # a hit is served from disk, without touching the network
+    url = 'http://127.0.0.1:9/poster.jpg'
+    name = cache.make_key(url) + '.jpg'
+    with open(os.path.join(subdir, name), 'wb') as f: f.write(b'cached')
+    nose.tools.eq_(cache.cached_download(url), b'cached')
+
+    # a failed download leaves no partial file behind
+    url = 'http://127.0.0.1:9/other.jpg'
+    with nose.tools.assert_raises(Exception):
+      cache.cached_download(url)
+    nose.tools.eq_(os.listdir(subdir), [name])
+
+
+def test_get_config():
+
+  tmpdir = tempfile.mkdtemp()
+  try:
+    fname = os.path.join(tmpdir, 'librarianrc')
+    parser = utils.get_config(fname) #missing file
+    nose.tools.eq_(parser.sections(), [])
+    nose.tools.eq_(utils.var_from_config(fname, 'tmdb', 'apikey'), None)
+
+    with open(fname, 'wt') as f: f.write('[tmdb]\napikey = first\n')
+    nose.tools.eq_(utils.var_from_config(fname, 'tmdb', 'apikey'), 'first')
+    assert utils.get_config(fname) is utils.get_config(fname) #cached
+    nose.tools.eq_(utils.var_from_config(fname, 'tvdb', 'apikey'), None)
+    nose.tools.eq_(utils.load_config_section(fname, 'tvdb'), None)
+
+    # an edit is picked up, even if the modification time is unchanged
+    st = os.stat(fname)
+    with open(fname, 'wt') as f: f.write('[tmdb]\napikey = changed\n')
+    os.utime(fname, ns=(st.st_atime_ns, st.st_mtime_ns))
+    nose.tools.eq_(utils.var_from_config(fname, 'tmdb', 'apikey'), 'changed')
+
+  finally:
+    shutil.rmtree(tmpdir)
+
+
+def test_parse_srt_fast():
+
+  text = '\ufeff1\r\n00:00:01,000 --> 00:00:02,500\r\nFirst line\r\n' \
+      'Second line\r\n\r\n' \
+      '2\r\n00:00:03.250 --> 00:00:04.000 X1:10 X2:20 Y1:30 Y2:40\r\n' \
+      'Dots and positioning\r\n\r\n' \
+      'not-an-index\r\n00:00:05,000 --> 00:00:06,000\r\nSkipped\r\n\r\n' \
+      '4\r\nno timings here\r\n\r\n' \
+      '5\r\n01:02:03,004 --> 01:02:04,005\r\nLast\r\n \t\r\n' \
+      '6\r\n01:02:05,000 --> 01:02:06,000\r\nAfter whitespace\r\n'
+
+  nose.tools.eq_(subtitles._parse_srt_fast(text), [
+    (1, 1000, 2500, '', 'First line\nSecond line'),
+    (2, 3250, 4000, 'X1:10 X2:20 Y1:30 Y2:40', 'Dots and positioning'),
+    (5, 3723004, 3724005, '', 'Last'),
+    (6, 3725000, 3726000, '', 'After whitespace'),
+    ])
+
+  # cues separated by whitespace-only lines, as pysrt would parse them
+  text = '1\n00:00:01,000 --> 00:00:02,000\nHello\n \n' \
+      '2\n00:00:03,000 --> 00:00:04,000 X1:1 X2:2 Y1:3 Y2:4\nWorld\n'
+  with tempfile.NamedTemporaryFile(suffix='.srt') as tmp:
+    tmp.write(text.encode('utf-8'))
+    tmp.flush()
+    loaded = subtitles._load_srt(tmp.name)
+  expected = pysrt.from_string(text)
+  nose.tools.eq_([(k.index, k.start, k.end, k.position, k.text) \
+      for k in loaded], [(k.index, k.start, k.end, k.position, k.text) \
+      for k in expected])
+  nose.tools.eq_(len(loaded), 2)
+  nose.tools.eq_(loaded[1].position, 'X1:1 X2:2 Y1:3 Y2:4')
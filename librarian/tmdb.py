@@ -4,12 +4,16 @@
 '''Functionality to deal with TMDB information and API'''
 
 import os
-import io
 import logging
-import tmdbsimple as tmdb
-from mutagen.mp4 import MP4, MP4Cover
+import sqlite3
+import functools
+import collections
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-from .utils import var_from_config
+from .utils import var_from_config, apple_plist
+from .utils import US_CONTENT_RATINGS_APPLE
+from .cache import JSONCache, cache_dir, make_key, cached_download
 
 logger = logging.getLogger(__name__)
 
@@ -42,6 +46,8 @@ def setup_apikey(user_provided=None):
 
   '''
 
+  import tmdbsimple as tmdb #lazy: pulls in requests and friends
+
   if user_provided is not None:
     tmdb.API_KEY = user_provided
     return
@@ -51,15 +57,10 @@ def setup_apikey(user_provided=None):
     tmdb.API_KEY = envkey
     return
 
-  if os.path.exists('.librarianrc'):
-    key = var_from_config('.librarianrc', 'apikeys', 'tmdb')
-    if key is not None:
-      tmdb.API_KEY = key
-      return
-
-  home_path = os.path.join(os.environ['HOME'], '.librarianrc')
-  if os.path.exists(home_path):
-    key = var_from_config(home_path, 'apikeys', 'tmdb')
+  # missing files are ignored while parsing, no need to check beforehand
+  home_path = os.path.expanduser(os.path.join('~', '.librarianrc'))
+  for path in ('.librarianrc', home_path):
+    key = var_from_config(path, 'apikeys', 'tmdb')
     if key is not None:
       tmdb.API_KEY = key
       return
@@ -67,28 +68,69 @@ def setup_apikey(user_provided=None):
   raise RuntimeError('Cannot setup TMDB API key')
 
 
-def record_from_query(query, year=None):
-  '''Retrieves the TMDB record using the provided query string
+class CachedMovie(object):
+  '''A movie record restored from the local cache
 
-  This function uses the tmdbsimple package to retrieve information from TMDB.
-  You should set the API key adequately module before calling it.
+  Objects of this type provide the same attributes as the ones of
+  :py:class:`tmdbsimple.Movies` objects after information, credits and
+  releases have been downloaded.
 
 
   Parameters:
 
-    query (dict): An arbitrary query string
-    year (:py:class:`int`, optional): If set, then filter search results by
-      year (this value should correspond to the 4-digit julian year - e.g.
-      2012)
+    data (dict): The merged TMDB responses for the movie
+
+  '''
+
+  def __init__(self, data):
+    self.__dict__.update(data)
+
+
+_record_cache = None
+
+
+def _get_record_cache():
+  '''Returns the cache for TMDB records, opening it on the first call'''
+
+  global _record_cache
+  if _record_cache is None:
+    path = os.path.join(cache_dir('tmdb'), 'records.sqlite')
+    _record_cache = JSONCache(path)
+  return _record_cache
+
+
+def _cache_get(key):
+  '''Reads a record from the cache, returns ``(None, False)`` if unusable'''
+
+  try:
+    return _get_record_cache().get(key)
+  except (OSError, ValueError, sqlite3.Error) as e:
+    logger.warn('Cannot read TMDB record cache (%s) - ignoring it', e)
+    return None, False
+
+
+def _cache_set(key, data):
+  '''Stores a record on the cache, if it is usable'''
+
+  try:
+    _get_record_cache().set(key, data)
+  except (OSError, ValueError, sqlite3.Error) as e:
+    logger.warn('Cannot update TMDB record cache (%s) - ignoring it', e)
+
+
+def _download_record(query, year):
+  '''Downloads a movie record from TMDB
 
 
   Returns:
 
-    obj: An object representing a movie returned from the tmdbsimple API, if a
-    match can be found. Otherwise, ``None``.
+    tuple: The movie object returned by tmdbsimple and a dictionary merging all
+    downloaded responses, suitable for caching. If no match is found, returns
+    ``(None, None)``.
 
   '''
 
+  import tmdbsimple as tmdb
   search = tmdb.Search()
   args = dict(query=query)
   if year is not None: args['year'] = year
@@ -99,16 +141,95 @@ def record_from_query(query, year=None):
         response['results'][0]['id'])
     retval = tmdb.Movies(response['results'][0]['id'])
 
-    # trigger downloading of a few resources
-    retval.info() #basic movie information
-    retval.credits() #cast
-    retval.releases() #ratings in US
-    return retval
+    # basic movie information, cast and US ratings in a single request
+    data = retval.info(append_to_response='credits,releases')
+    data.update(data.pop('credits', {}))
+    data.update(data.pop('releases', {}))
+    for k in ('cast', 'crew', 'countries'): setattr(retval, k, data.get(k, []))
+    return retval, data
+
+  return None, None
+
+
+def _refresh_record(key, query, year):
+  '''Downloads a movie record and updates the cache with it'''
+
+  try:
+    movie, data = _download_record(query, year)
+    if data is not None: _cache_set(key, data)
+  except Exception as e:
+    logger.warn('Could not refresh cached TMDB record for `%s\': %s', query, e)
+
+
+def record_from_query(query, year=None, use_cache=True):
+  '''Retrieves the TMDB record using the provided query string
+
+  This function uses the tmdbsimple package to retrieve information from TMDB.
+  You should set the API key adequately module before calling it.
+
+  Records are kept in a local cache (see :py:func:`librarian.cache.cache_dir`)
+  for a week. Records older than that are still used, but are refreshed in
+  the background.
+
+
+  Parameters:
+
+    query (dict): An arbitrary query string
+    year (:py:class:`int`, optional): If set, then filter search results by
+      year (this value should correspond to the 4-digit julian year - e.g.
+      2012)
+    use_cache (:py:class:`bool`, optional): If set to ``False``, then always
+      contact TMDB, refreshing the locally cached record
+
+
+  Returns:
+
+    obj: An object representing a movie returned from the tmdbsimple API (or
+    restored from the local cache), if a match can be found. Otherwise,
+    ``None``.
+
+  '''
+
+  return _lookup(query, year, use_cache, background=True)
 
-  return None
 
+def _lookup(query, year, use_cache, background):
+  '''Implements :py:func:`record_from_query`
 
-def record_from_guess(guess):
+  If ``background`` is set, stale records are refreshed on a separate thread.
+  Otherwise, they are refreshed before returning, on the calling thread, which
+  keeps batch lookups within the bounds of their thread pool.
+  '''
+
+  key = make_key(query, year)
+
+  if use_cache:
+    data, fresh = _cache_get(key)
+    if data is not None:
+      logger.info('Using cached TMDB record for `%s\'', query)
+      if fresh: return CachedMovie(data)
+      if background:
+        logger.info('Cached record is stale - refreshing in the background')
+        threading.Thread(target=_refresh_record,
+            args=(key, query, year)).start()
+        return CachedMovie(data)
+      logger.info('Cached record is stale - refreshing')
+      try:
+        retval, fetched = _download_record(query, year)
+      except Exception as e:
+        logger.warn('Could not refresh cached TMDB record for `%s\': %s',
+            query, e)
+        return CachedMovie(data)
+      if fetched is None: return CachedMovie(data) #like _refresh_record()
+      _cache_set(key, fetched)
+      return retval
+
+  retval, data = _download_record(query, year)
+  if data is not None: _cache_set(key, data)
+  return retval
+
+
+def record_from_guess(guess, use_cache=True):
   '''Retrieves the TMDB record using the provided guess
 
   This function uses the tmdbsimple package to retrieve information from TMDB.
@@ -119,6 +240,8 @@ def record_from_guess(guess):
 
     guess (dict): A dictionary containing the guessed information from the
       movie
+    use_cache (:py:class:`bool`, optional): If set to ``False``, then always
+      contact TMDB, refreshing the locally cached record
 
 
   Returns:
@@ -127,14 +250,124 @@ def record_from_guess(guess):
 
   '''
 
-  return record_from_query(guess['title'], guess.get('year'))
+  return record_from_query(guess['title'], guess.get('year'), use_cache)
+
+
+def record_from_queries(queries, years=None, use_cache=True, max_workers=8):
+  '''Retrieves TMDB records for many query strings at once
+
+  Lookups are network-bound and independent from each other, so they are
+  issued concurrently, with at most ``max_workers`` lookups in flight. No
+  other threads are started: stale cached records are refreshed by the worker
+  that finds them (instead of in the background, like
+  :py:func:`record_from_query` does) and posters are only downloaded by
+  :py:func:`retag`.
+  Keep this number modest (at most the 8 connections kept alive by
+  :py:func:`librarian.utils.download`), so as to respect TMDB's request rate
+  limits. You should set the API key adequately before calling it.
+
+
+  Parameters:
 
+    queries (list): A list of arbitrary query strings
+    years (:py:class:`list`, optional): If set, a list with the same length as
+      ``queries``, with the year to filter each search by (or ``None``)
+    use_cache (:py:class:`bool`, optional): If set to ``False``, then always
+      contact TMDB, refreshing the locally cached records
+    max_workers (:py:class:`int`, optional): The maximum number of concurrent
+      lookups
+
+
+  Returns:
+
+    list: Objects representing each movie (or ``None``, if no match was found),
+    in the same order as ``queries``
+
+  '''
+
+  if years is None: years = [None] * len(queries)
+
+  with ThreadPoolExecutor(max_workers=max_workers) as executor:
+    return list(executor.map(lambda q, y: _lookup(q, y, use_cache, False),
+      queries, years))
+
+
+def record_from_guesses(guesses, use_cache=True, max_workers=8):
+  '''Retrieves TMDB records for many guesses at once
+
+  Lookups are network-bound and independent from each other, so they are
+  issued concurrently, with at most ``max_workers`` lookups in flight. You
+  should set the API key adequately before calling it.
+
+
+  Parameters:
+
+    guesses (list): A list of dictionaries containing the guessed information
+      from each movie
+    use_cache (:py:class:`bool`, optional): If set to ``False``, then always
+      contact TMDB, refreshing the locally cached records
+    max_workers (:py:class:`int`, optional): The maximum number of concurrent
+      lookups
+
+
+  Returns:
+
+    list: Objects representing each movie (or ``None``, if no match was found),
+    in the same order as ``guesses``
+
+  '''
 
-def _make_apple_plist(movie):
+  return record_from_queries([k['title'] for k in guesses],
+      [k.get('year') for k in guesses], use_cache, max_workers)
+
+
+People = collections.namedtuple('People',
+    ['cast', 'writers', 'directors', 'producers', 'genres'])
+
+
+_DEPARTMENTS = frozenset(('Writing', 'Directing', 'Production'))
+
+
+def _extract_people(movie):
+  '''Extracts names of the main cast, crew and genres of a movie
+
+  Only the first 5 names of each group of people are kept.
+
+
+  Parameters:
+
+    movie (obj): An object returned by the TMDB API implementation
+
+
+  Returns:
+
+    People: A named tuple with lists of names for the ``cast``, ``writers``,
+    ``directors``, ``producers`` and movie ``genres``
+
+  '''
+
+  # partitions the crew by department in a single pass, keeping 5 names each
+  buckets = dict((k, []) for k in _DEPARTMENTS)
+  for k in movie.crew:
+    if k['department'] not in _DEPARTMENTS: continue
+    bucket = buckets[k['department']]
+    if len(bucket) < 5: bucket.append(k['name'])
+
+  return People(
+      cast=[k['name'] for k in movie.cast[:5]],
+      writers=buckets['Writing'],
+      directors=buckets['Directing'],
+      producers=buckets['Production'],
+      genres=[k['name'] for k in movie.genres],
+      )
+
+
+def _make_apple_plist(people):
   '''Builds an XML string with movie information
 
   Returns a string containing a XML document which can be parsed by Apple
-  movie players. It contains information about the cast and crew of the movie.
+  movie players. It contains information about the cast and crew of the movie,
+  as returned by :py:func:`_extract_people`.
 
   The XML document is written in a single string with now new-lines. If it
   would be indented, it could look like this:
@@ -176,40 +409,12 @@ def _make_apple_plist(movie):
 
   logger.debug('Building XML info tree...')
 
-  from xml.etree import ElementTree
-
-  header = b'<?xml version="1.0" encoding="UTF-8"?>' \
-      b'<!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" ' \
-      b'"http://www.apple.com/DTDs/PropertyList-1.0.dtd">'
-
-  output = io.BytesIO()
-  output.write(header)
-
-  # creates root elements
-  plist  = ElementTree.Element('plist', {'version': '1.0'})
-  keyval = ElementTree.SubElement(plist, 'dict')
-
-  # inserts a section of
-  def _insert_section(name, entries):
-    ElementTree.SubElement(keyval, 'key').text = name
-    array = ElementTree.SubElement(keyval, 'array')
-    for k in entries:
-      kv = ElementTree.SubElement(array, 'dict')
-      ElementTree.SubElement(kv, 'key').text = 'name'
-      ElementTree.SubElement(kv, 'string').text = k['name']
-
-  _insert_section('cast', movie.cast[:5])
-  all_writers = [k for k in movie.crew if k['department'] == 'Writing']
-  _insert_section('screenwriters', all_writers[:5])
-  all_directors = [k for k in movie.crew if k['department'] == 'Directing']
-  _insert_section('directors', all_directors[:5])
-  all_producers = [k for k in movie.crew if k['department'] == 'Production']
-  _insert_section('producers', all_producers[:5])
-
-  et = ElementTree.ElementTree(plist)
-  et.write(output, encoding='utf-8')
-
-  return output.getvalue()
+  return apple_plist([
+    ('cast', people.cast),
+    ('screenwriters', people.writers),
+    ('directors', people.directors),
+    ('producers', people.producers),
+    ])
 
 
 def _image_url(movie, width=500):
@@ -221,26 +426,33 @@ def _image_url(movie, width=500):
 def _get_image(movie):
   '''Downloads an image associated to a movie into a pre-opened file'''
 
-  from six.moves import urllib
-
   url = _image_url(movie)
   logger.debug('Trying to retrieve image at %s', url)
-  return urllib.request.urlopen(url).read()
+  return cached_download(url, key=movie.poster_path, subdir='posters')
 
 
 def _us_certification(movie):
   '''Outputs the string for MPAA certification, if available'''
 
-  from .utils import US_CONTENT_RATINGS_APPLE
-  ratings_us = [k for k in movie.countries if k['iso_3166_1'] == 'US']
-  if ratings_us:
-    return US_CONTENT_RATINGS_APPLE[ratings_us[0].get('certification')]
-  else:
-    return US_CONTENT_RATINGS_APPLE[None]
+  us = next((k for k in movie.countries if k['iso_3166_1'] == 'US'), None)
+  cert = us and us.get('certification')
+  return US_CONTENT_RATINGS_APPLE.get(cert, US_CONTENT_RATINGS_APPLE[None])
 
 
 def _hd_tag(filename):
-  '''Calculates the proper HD tag to use given a movie file'''
+  '''Calculates the proper HD tag to use given a movie file
+
+  Results are cached for as long as the file is not modified, so the file is
+  only probed once when both :py:func:`pretty_print` and :py:func:`retag` are
+  called.
+  '''
+
+  return _hd_tag_cached(filename, os.path.getmtime(filename))
+
+
+@functools.lru_cache(maxsize=256)
+def _hd_tag_cached(filename, mtime):
+  '''Calculates the HD tag for a given version (mtime) of a movie file'''
 
   from .convert import probe, _get_streams, _get_default_stream
   data = probe(filename)
@@ -254,6 +466,56 @@ def _hd_tag(filename):
   return '0'
 
 
+def _padding(info):
+  '''Decides on the amount of padding to leave after MP4 tags are written
+
+  If the new tags fit in the space currently available in the file, keep it as
+  is so mutagen can write them in place. Otherwise, reserve extra room so
+  subsequent re-tagging does not require rewriting the whole file again.
+  '''
+
+  if info.padding >= 0: return info.padding
+  return 32768
+
+
+TagPlan = collections.namedtuple('TagPlan',
+    ['genres', 'plist', 'certification', 'image_url'])
+
+
+def _tag_plan(movie):
+  '''Computes the tag values depending only on the movie record
+
+  The plan is computed once and kept with the movie record, so that calling
+  :py:func:`pretty_print` and then :py:func:`retag` on the same record does not
+  build the plist twice. The HD tag depends on the file and is cached by
+  :py:func:`_hd_tag` instead.
+
+
+  Parameters:
+
+    movie (obj): An object returned by the TMDB API implementation
+
+
+  Returns:
+
+    TagPlan: A named tuple with the movie ``genres``, the iTunMOVI ``plist``,
+    the US ``certification`` and the poster ``image_url`` (or ``None``)
+
+  '''
+
+  plan = getattr(movie, '_tag_plan', None)
+  if plan is None:
+    people = _extract_people(movie)
+    plan = movie._tag_plan = TagPlan(
+        genres=people.genres,
+        plist=_make_apple_plist(people),
+        certification=_us_certification(movie),
+        image_url=_image_url(movie) if getattr(movie, 'poster_path', None) \
+            else None,
+        )
+  return plan
+
+
 def pretty_print(filename, movie):
   '''Prints how the movie file is going to be retagged
 
@@ -268,6 +530,7 @@ def pretty_print(filename, movie):
   '''
 
   hd_tag = _hd_tag(filename)
+  plan = _tag_plan(movie)
 
   print("Filename = %s" % filename)
   print("\xa9nam = %s" % movie.title)
@@ -276,11 +539,22 @@ def pretty_print(filename, movie):
   print("\xa9day = %s" % movie.release_date)
   print("stik = [9] # Movie iTunes category")
   print("hdvd = %s # 0: low res; 1: 720p; 2: 1080p or superior" % hd_tag)
-  print("\xa9gen = %s" % ([k['name'] for k in movie.genres],))
-  print("covr = %s" % _image_url(movie) if hasattr(movie, 'poster_path') \
-      else None)
-  print("----:com.apple.iTunes:iTunEXTC = %s" % _us_certification(movie))
-  print("----:com.apple.iTunes:iTunMOVI = %s" % _make_apple_plist(movie))
+  print("\xa9gen = %s" % (plan.genres,))
+  print("covr = %s" % plan.image_url)
+  print("----:com.apple.iTunes:iTunEXTC = %s" % plan.certification)
+  print("----:com.apple.iTunes:iTunMOVI = %s" % plan.plist)
+
+
+# freeform atom holding the signature of the information last written
+_SIGNATURE_ATOM = '----:com.librarian:sig'
+
+
+def _signature(movie, plan):
+  '''Returns a digest of all the information :py:func:`retag` writes'''
+
+  return make_key(movie.id, movie.title, movie.tagline, movie.overview,
+      movie.release_date, getattr(movie, 'poster_path', None), plan.genres,
+      plan.plist, plan.certification).encode('ascii')
 
 
 def retag(filename, movie):
@@ -294,36 +568,90 @@ def retag(filename, movie):
     movie (obj): An object returned by the TMDB API implementation containing
       all fields required to retag the movie
 
+
+  Returns:
+
+    bool: ``False`` if the file was already tagged with the same information
+    and was left untouched, ``True`` otherwise
+
   '''
 
+  from mutagen.mp4 import MP4, MP4Cover
+
   logger.info("Tagging file: %s" % filename)
-  hd_tag = _hd_tag(filename)
-  video = MP4(filename)
 
-  try:
-    video.delete()
-    logger.debug("Successfuly deleted currently existing tags on file")
-  except IOError:
-    logger.warn("Unable to clear original tags, attempting to proceed...")
-
-  video["\xa9nam"] = movie.title
-  video["desc"] = movie.tagline
-  video["ldes"] = movie.overview
-  video["\xa9day"] = movie.release_date
-  video["stik"] = [9]  # Movie iTunes category
-  video["hdvd"] = [hd_tag]
-  video["\xa9gen"] = [k['name'] for k in movie.genres]
-  video["----:com.apple.iTunes:iTunMOVI"] = _make_apple_plist(movie)
-  video["----:com.apple.iTunes:iTunEXTC"] = _us_certification(movie)
-
-  if hasattr(movie, 'poster_path'):
-    bindata = _get_image(movie)
-    if movie.poster_path.endswith('.png'):
-      video["covr"] = [MP4Cover(bindata, MP4Cover.FORMAT_PNG)]
+  video = MP4(filename)
+  plan = _tag_plan(movie)
+  signature = _signature(movie, plan)
+
+  if video.tags is not None and \
+      [bytes(k) for k in video.tags.get(_SIGNATURE_ATOM, [])] == [signature]:
+    logger.info("File is already tagged with this information, skipping")
+    return False
+
+  # probing and image download run while tags are being set
+  with ThreadPoolExecutor(max_workers=2) as executor:
+    hd_tag = executor.submit(_hd_tag, filename)
+    if getattr(movie, 'poster_path', None):
+      image = executor.submit(_get_image, movie)
     else:
-      video["covr"] = [MP4Cover(bindata, MP4Cover.FORMAT_JPEG)]
-    logger.info('Finally saving tags to file...')
-
-  video.save()
+      image = None
+
+    # clears existing tags in memory only: the single save() below rewrites
+    if video.tags is None: video.add_tags()
+    else: video.tags.clear()
+    logger.debug("Cleared currently existing tags on file")
+
+    video.tags.update({
+      "\xa9nam": movie.title,
+      "desc": movie.tagline,
+      "ldes": movie.overview,
+      "\xa9day": movie.release_date,
+      "stik": [9],  # Movie iTunes category
+      "\xa9gen": plan.genres,
+      "----:com.apple.iTunes:iTunMOVI": plan.plist,
+      "----:com.apple.iTunes:iTunEXTC": plan.certification,
+      "hdvd": [int(hd_tag.result())],
+      _SIGNATURE_ATOM: signature,
+      })
+
+    if image is not None:
+      bindata = image.result()
+      if movie.poster_path.endswith('.png'):
+        video["covr"] = [MP4Cover(bindata, MP4Cover.FORMAT_PNG)]
+      else:
+        video["covr"] = [MP4Cover(bindata, MP4Cover.FORMAT_JPEG)]
+
+  logger.info('Finally saving tags to file...')
+  video.save(padding=_padding)
 
   logger.info("Tags written successfully")
+  return True
+
+
+def retag_many(pairs, workers=5):
+  '''Re-tags many MP4 files at once
+
+  Each file is re-tagged with :py:func:`retag`. Probing, poster downloads and
+  writing mostly wait on I/O, so files are processed concurrently, with at most
+  ``workers`` files in flight.
+
+
+  Parameters:
+
+    pairs (list): A list of tuples ``(filename, movie)``, as you would pass to
+      :py:func:`retag`
+
+    workers (:py:class:`int`, optional): The maximum number of files to
+      re-tag concurrently
+
+
+  Returns:
+
+    list: The values returned by :py:func:`retag` for each file, in the same
+    order as ``pairs``
+
+  '''
+
+  with ThreadPoolExecutor(max_workers=workers) as executor:
+    return list(executor.map(lambda k: retag(*k), pairs))
@@ -4,12 +4,13 @@
 '''Functionality to deal with TVDB information and API'''
 
 import os
-import io
 import logging
-import pytvdbapi.api as tvdb
-from mutagen.mp4 import MP4, MP4Cover
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
 
-from .utils import var_from_config
+from .utils import var_from_config, apple_plist
+from .utils import US_CONTENT_RATINGS_APPLE
+from .cache import JSONCache, cache_dir, make_key, cached_download
 
 logger = logging.getLogger(__name__)
 server = None
@@ -46,6 +47,7 @@ def setup_apikey(user_provided=None):
   '''
 
   global server
+  import pytvdbapi.api as tvdb #lazy: only needed for TV shows
 
   if user_provided is not None:
     server = tvdb.TVDB(user_provided)
@@ -56,15 +58,10 @@ def setup_apikey(user_provided=None):
     server = tvdb.TVDB(envkey)
     return
 
-  if os.path.exists('.librarianrc'):
-    key = var_from_config('.librarianrc', 'apikeys', 'tvdb')
-    if key is not None:
-      server = tvdb.TVDB(key)
-      return
-
-  home_path = os.path.join(os.environ['HOME'], '.librarianrc')
-  if os.path.exists(home_path):
-    key = var_from_config(home_path, 'apikeys', 'tvdb')
+  # missing files are ignored while parsing, no need to check beforehand
+  home_path = os.path.expanduser(os.path.join('~', '.librarianrc'))
+  for path in ('.librarianrc', home_path):
+    key = var_from_config(path, 'apikeys', 'tvdb')
     if key is not None:
       server = tvdb.TVDB(key)
       return
@@ -72,7 +69,56 @@ def setup_apikey(user_provided=None):
   raise RuntimeError('Cannot setup TVDB API key')
 
 
-def record_from_query(query, season=1, episode=1, language='en'):
+_search_cache = None
+
+
+def _get_search_cache():
+  '''Returns the cache of TVDB show identifiers, opening it on the first call'''
+
+  global _search_cache
+  if _search_cache is None:
+    path = os.path.join(cache_dir('tvdb'), 'search.sqlite')
+    _search_cache = JSONCache(path)
+  return _search_cache
+
+
+def _cache_get(key):
+  '''Reads a show id from the cache, returns ``(None, False)`` if unusable'''
+
+  try:
+    return _get_search_cache().get(key)
+  except (OSError, ValueError, sqlite3.Error) as e:
+    logger.warn('Cannot read TVDB search cache (%s) - ignoring it', e)
+    return None, False
+
+
+def _cache_set(key, show_id):
+  '''Stores a show id on the cache, if it is usable'''
+
+  try:
+    _get_search_cache().set(key, show_id)
+  except (OSError, ValueError, sqlite3.Error) as e:
+    logger.warn('Cannot update TVDB search cache (%s) - ignoring it', e)
+
+
+def _find_show(query, language, use_cache):
+  '''Finds the TV show matching the query, using the cached show id if fresh'''
+
+  key = make_key(query, language)
+
+  if use_cache:
+    show_id, fresh = _cache_get(key)
+    if show_id is not None and fresh:
+      logger.info('Using cached TVDB show id=`%d\' for `%s\'', show_id, query)
+      return server.get_series(show_id, language)
+
+  show = server.search(query, language=language)[0]
+  _cache_set(key, show.id)
+  return show
+
+
+def record_from_query(query, season=1, episode=1, language='en',
+    use_cache=True):
   '''Retrieves the TVDB record for a TV show using the provided query string
 
   This function uses the pytvdbapi package to retrieve information from TVDB.
@@ -90,6 +136,8 @@ def record_from_query(query, season=1, episode=1, language='en'):
       Examples are ``pt`` for Portuguese, ``fr`` for French or ``es`` for
       Spanish. A complete list can be found on wikipedia
       (https://en.wikipedia.org/wiki/List_of_ISO_639-1_codes)
+    use_cache (:py:class:`bool`, optional): If set to ``False``, then always
+      search TVDB for the show, refreshing the locally cached show identifier
 
 
   Returns:
@@ -100,11 +148,10 @@ def record_from_query(query, season=1, episode=1, language='en'):
 
   logger.info('Searching TVDB for `%s\', Season %d, Episode %d ' \
       '(language=`%s\')', query, season, episode, language)
-  search = server.search(query, language=language)
-  return search[0][season][episode]
+  return _find_show(query, language, use_cache)[season][episode]
 
 
-def record_from_guess(guess, language='en'):
+def record_from_guess(guess, language='en', use_cache=True):
   '''Retrieves the TVDB record using the provided guess
 
   This function uses the ``pytvdbapi`` package to retrieve information from
@@ -121,6 +168,8 @@ def record_from_guess(guess, language='en'):
       Examples are ``pt`` for Portuguese, ``fr`` for French or ``es`` for
       Spanish. A complete list can be found on wikipedia
       (https://en.wikipedia.org/wiki/List_of_ISO_639-1_codes)
+    use_cache (:py:class:`bool`, optional): If set to ``False``, then always
+      search TVDB for the show, refreshing the locally cached show identifier
 
 
   Returns:
@@ -130,7 +179,7 @@ def record_from_guess(guess, language='en'):
   '''
 
   return record_from_query(guess['title'], guess['season'], guess['episode'],
-      language)
+      language, use_cache)
 
 
 def _make_apple_plist(episode):
@@ -173,36 +222,11 @@ def _make_apple_plist(episode):
 
   logger.debug('Building XML info tree...')
 
-  from xml.etree import ElementTree
-
-  header = b'<?xml version="1.0" encoding="UTF-8"?>' \
-      b'<!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" ' \
-      b'"http://www.apple.com/DTDs/PropertyList-1.0.dtd">'
-
-  output = io.BytesIO()
-  output.write(header)
-
-  # creates root elements
-  plist  = ElementTree.Element('plist', {'version': '1.0'})
-  keyval = ElementTree.SubElement(plist, 'dict')
-
-  # inserts a section of
-  def _insert_section(name, entries):
-    ElementTree.SubElement(keyval, 'key').text = name
-    array = ElementTree.SubElement(keyval, 'array')
-    for k in entries:
-      kv = ElementTree.SubElement(array, 'dict')
-      ElementTree.SubElement(kv, 'key').text = 'name'
-      ElementTree.SubElement(kv, 'string').text = k
-
-  _insert_section('cast', episode.season.show.Actors[:5])
-  _insert_section('screenwriters', episode.Writer)
-  _insert_section('directors', [episode.Director])
-
-  et = ElementTree.ElementTree(plist)
-  et.write(output, encoding='utf-8')
-
-  return output.getvalue()
+  return apple_plist([
+    ('cast', episode.season.show.Actors[:5]),
+    ('screenwriters', episode.Writer),
+    ('directors', [episode.Director]),
+    ])
 
 
 def _image_url(episode):
@@ -211,20 +235,19 @@ def _image_url(episode):
   episode.season.show.load_banners()
 
   # tries to get the most adequate banner for the season
-  season_banners = [k for k in episode.season.show.banner_objects if \
-      k.BannerType == 'season' and k.Season == episode.season.season_number]
+  banner = next((k for k in episode.season.show.banner_objects if \
+      k.BannerType == 'season' and k.Season == episode.season.season_number),
+      None)
 
-  if not season_banners:
+  if banner is None:
     return None
 
-  return season_banners[0].banner_url
+  return banner.banner_url
 
 
 def _get_image(episode):
   '''Downloads an image associated to a TV show into a pre-opened file'''
 
-  from six.moves import urllib
-
   url = _image_url(episode)
 
   if url is None:
@@ -233,14 +256,14 @@ def _get_image(episode):
     return None, None
 
   logger.debug('Trying to retrieve image at %s', url)
-  return urllib.request.urlopen(url).read(), url[-4:]
+  return cached_download(url, subdir='posters'), url[-4:]
 
 
 def _us_certification(episode):
   '''Outputs the string for MPAA certification, if available'''
 
-  from .utils import US_CONTENT_RATINGS_APPLE
-  return US_CONTENT_RATINGS_APPLE[episode.season.show.ContentRating]
+  return US_CONTENT_RATINGS_APPLE.get(episode.season.show.ContentRating,
+      US_CONTENT_RATINGS_APPLE[None])
 
 
 def _make_short_description(overview):
@@ -252,7 +275,9 @@ def _make_short_description(overview):
   if len(overview) < max_size: return overview
 
   # get the first few phrases so that the total size is still < 256
-  return '.'.join(overview[:max_size].split('.')[:-1]) + '.'
+  idx = overview.rfind('.', 0, max_size)
+  if idx == -1: return overview[:max_size]
+  return overview[:idx+1]
 
 
 def pretty_print(filename, episode):
@@ -305,44 +330,51 @@ def retag(filename, episode):
       all fields required to retag the TV show episode
 
   '''
-  from .tmdb import _hd_tag
+  from .tmdb import _hd_tag, _padding
+  from mutagen.mp4 import MP4, MP4Cover
 
   logger.info("Tagging file: %s" % filename)
-  hd_tag = _hd_tag(filename)
-  video = MP4(filename)
 
-  try:
-    video.delete()
-    logger.debug("Successfuly deleted currently existing tags on file")
-  except IOError:
-    logger.warn("Unable to clear original tags, attempting to proceed...")
-
-  video["tvsh"] = episode.season.show.SeriesName
-  video["\xa9nam"] = episode.EpisodeName
-  video["tven"] = episode.EpisodeName
-  video["desc"] = _make_short_description(episode.Overview)
-  video["ldes"] = episode.Overview
-  video["tvnn"] = episode.season.show.Network
-  video["\xa9day"] = episode.FirstAired.strftime('%Y-%m-%d')
-  video["tvsn"] = [episode.season.season_number]
-  video["disk"] = [(episode.season.season_number, len(episode.season.show))]
-  video["\xa9alb"] = '%s, Season %d' % (episode.season.show.SeriesName,
-      episode.season.season_number)
-  video["tves"] = [episode.EpisodeNumber]
-  video["trkn"] = [(episode.EpisodeNumber, len(episode.season))]
-  video["stik"] = [10]  # TV show iTunes category
-  video["hdvd"] = [hd_tag]
-  video["\xa9gen"] = episode.season.show.Genre
-  video["----:com.apple.iTunes:iTunMOVI"] = _make_apple_plist(episode)
-  video["----:com.apple.iTunes:iTunEXTC"] = _us_certification(episode)
-
-  bindata, imtype = _get_image(episode)
-  if bindata is not None:
-    if imtype == '.png':
-      video["covr"] = [MP4Cover(bindata, MP4Cover.FORMAT_PNG)]
-    else:
-      video["covr"] = [MP4Cover(bindata, MP4Cover.FORMAT_JPEG)]
+  # probing and image download run while the MP4 file is being parsed
+  with ThreadPoolExecutor(max_workers=2) as executor:
+    hd_tag = executor.submit(_hd_tag, filename)
+    image = executor.submit(_get_image, episode)
+
+    video = MP4(filename)
+
+    # clears existing tags in memory only: the single save() below rewrites
+    if video.tags is None: video.add_tags()
+    else: video.tags.clear()
+    logger.debug("Cleared currently existing tags on file")
+
+    video.tags.update({
+      "tvsh": episode.season.show.SeriesName,
+      "\xa9nam": episode.EpisodeName,
+      "tven": episode.EpisodeName,
+      "desc": _make_short_description(episode.Overview),
+      "ldes": episode.Overview,
+      "tvnn": episode.season.show.Network,
+      "\xa9day": episode.FirstAired.strftime('%Y-%m-%d'),
+      "tvsn": [episode.season.season_number],
+      "disk": [(episode.season.season_number, len(episode.season.show))],
+      "\xa9alb": '%s, Season %d' % (episode.season.show.SeriesName,
+        episode.season.season_number),
+      "tves": [episode.EpisodeNumber],
+      "trkn": [(episode.EpisodeNumber, len(episode.season))],
+      "stik": [10],  # TV show iTunes category
+      "\xa9gen": episode.season.show.Genre,
+      "----:com.apple.iTunes:iTunMOVI": _make_apple_plist(episode),
+      "----:com.apple.iTunes:iTunEXTC": _us_certification(episode),
+      "hdvd": [int(hd_tag.result())],
+      })
+
+    bindata, imtype = image.result()
+    if bindata is not None:
+      if imtype == '.png':
+        video["covr"] = [MP4Cover(bindata, MP4Cover.FORMAT_PNG)]
+      else:
+        video["covr"] = [MP4Cover(bindata, MP4Cover.FORMAT_JPEG)]
 
   logger.info('Finally saving tags to file...')
-  video.save()
+  video.save(padding=_padding)
   logger.info("Tags written successfully")
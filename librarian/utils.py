@@ -6,11 +6,13 @@
 
 import os
 import sys
+import copy
+import time
 import logging
+import functools
+import contextlib
 import babelfish
-from six.moves import configparser
-
-import guessit
+import configparser
 
 logger = logging.getLogger(__name__)
 
@@ -33,11 +35,156 @@ US_CONTENT_RATINGS_APPLE = {
     }
 
 
+# Opening of Apple property lists used for iTunes movie information
+_PLIST_HEADER = b'<?xml version="1.0" encoding="UTF-8"?>' \
+    b'<!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" ' \
+    b'"http://www.apple.com/DTDs/PropertyList-1.0.dtd">' \
+    b'<plist version="1.0"><dict>'
+_PLIST_FOOTER = b'</dict></plist>'
+_PLIST_ARRAY_CLOSE = b'</array>'
+_PLIST_NAME_OPEN = b'<dict><key>name</key><string>'
+_PLIST_NAME_CLOSE = b'</string></dict>'
+_PLIST_NAME_SEP = '</string></dict><dict><key>name</key><string>'
+_XML_ESCAPE = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;'})
+
+
+def apple_plist(sections):
+  '''Builds an Apple property list (XML) containing lists of names
+
+  The document is written in a single string with no new-lines. Each section
+  becomes a key, associated to an array of dictionaries with a single ``name``
+  entry each. For example:
+
+  .. code-block:: xml
+
+     <key>directors</key>
+     <array>
+       <dict><key>name</key><string>George Lucas</string></dict>
+     </array>
+
+
+  Parameters:
+
+    sections (list): A list of tuples ``(key, names)``, where ``key`` is the
+      name of the section (e.g. ``cast``) and ``names`` a list of strings
+
+
+  Returns:
+
+    bytes: The UTF-8 encoded XML document
+
+  '''
+
+  parts = [_PLIST_HEADER]
+  for key, names in sections:
+    parts.append(b'<key>' + key.encode('utf-8') + b'</key><array>')
+    if names:
+      # all names of a section are escaped, joined and encoded in one go
+      parts.append(_PLIST_NAME_OPEN)
+      parts.append(_PLIST_NAME_SEP.join((k or '').translate(_XML_ESCAPE) \
+          for k in names).encode('utf-8'))
+      parts.append(_PLIST_NAME_CLOSE)
+    parts.append(_PLIST_ARRAY_CLOSE)
+  parts.append(_PLIST_FOOTER)
+  return b''.join(parts)
+
+
+_http_session = None
+
+
+def download(url, timeout=10, fileobj=None):
+  '''Downloads the contents of a URL
+
+  A single :py:class:`requests.Session` is shared by all calls so that
+  connections to the same host (e.g. image servers) are kept alive and reused.
+
+
+  Parameters:
+
+    url (str): The URL to download
+
+    timeout (:py:class:`float`, optional): Number of seconds to wait for the
+      server to respond
+
+    fileobj (:py:class:`file`, optional): If set, the contents are streamed
+      into this binary file object, in chunks, instead of being returned
+
+
+  Returns:
+
+    bytes: The contents of the URL, or ``None`` if ``fileobj`` is set
+
+
+  Raises:
+
+    requests.HTTPError: In case the server reports an error
+
+  '''
+
+  global _http_session
+  if _http_session is None:
+    import requests
+    from requests.adapters import HTTPAdapter
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    _http_session = session
+
+  response = _http_session.get(url, timeout=timeout,
+      stream=fileobj is not None)
+  response.raise_for_status()
+  if fileobj is None: return response.content
+
+  with contextlib.closing(response):
+    for chunk in response.iter_content(64*1024): fileobj.write(chunk)
+
+
+@functools.lru_cache(maxsize=4)
+def _parse_config(path, mtime, size):
+  '''Parses a configuration file, for a given modification time and size'''
+
+  # slurps the (small) file at once, then parses it from memory
+  with open(path, encoding='utf-8') as f:
+    data = f.read()
+  parser = configparser.ConfigParser()
+  parser.read_string(data, source=path)
+  return parser
+
+
+def get_config(fname):
+  '''Returns the parsed contents of an INI-style configuration file
+
+  Parsed files are cached until they are modified (the size is checked as
+  well, as modification times may be coarse on some filesystems), and the
+  same parser is returned to all callers. To read several values from the
+  same file, prefer calling this function once and querying the returned
+  parser. Do not modify it.
+
+
+  Parameters:
+
+    fname (str): The path to the configuration file
+
+
+  Returns:
+
+    configparser.ConfigParser: The shared parser for the file. If the file
+    does not exist or cannot be read, an empty parser
+
+  '''
+
+  try:
+    st = os.stat(fname)
+    return _parse_config(os.path.abspath(fname), st.st_mtime_ns, st.st_size)
+  except OSError: #missing or unreadable
+    return configparser.ConfigParser()
+
+
 def load_config_section(fname, section):
   '''Loads a whole section from a configuration file'''
 
-  parser = configparser.ConfigParser()
-  parser.read(fname)
+  parser = get_config(fname)
   if section in parser: return parser[section]
   return None
 
@@ -45,11 +192,34 @@ def load_config_section(fname, section):
 def var_from_config(fname, section, name):
   '''Loads information from a INI-style configuration file'''
 
-  parser = configparser.ConfigParser()
-  parser.read(fname)
-  if section in parser:
-    return parser[section].get(name)
-  return None
+  return get_config(fname).get(section, name, fallback=None)
+
+
+class _InfoFilter(logging.Filter):
+  '''Lets through only records up to the ``INFO`` level'''
+  def filter(self, record): return record.levelno <= logging.INFO
+
+
+class _LogFormatter(logging.Formatter):
+  '''A formatter that formats the date and time at most once per second'''
+
+  _last = (None, '') #(second, formatted date and time), replaced atomically
+
+  def formatTime(self, record, datefmt=None):
+    if datefmt is not None: return super().formatTime(record, datefmt)
+    second = int(record.created)
+    last_second, formatted = self._last
+    if second != last_second:
+      formatted = time.strftime(self.default_time_format,
+          self.converter(second))
+      self._last = (second, formatted)
+    return self.default_msec_format % (formatted, record.msecs)
+
+
+_LOG_FORMATTER = _LogFormatter("%(name)s@%(asctime)s -- %(levelname)s: " \
+    "%(message)s")
+_LOG_INFO_FILTER = _InfoFilter()
+_LOG_LEVELS = {0: logging.ERROR, 1: logging.WARNING, 2: logging.INFO}
 
 
 def setup_logger(name, verbosity):
@@ -65,33 +235,41 @@ def setup_logger(name, verbosity):
       warnings and informational messages and, finally, ``3``, all types of
       messages including debugging ones.
 
+  Handlers are only installed on the first call for a given logger. Further
+  calls just adjust its level, so records are never output more than once.
+
+  If the environment variable ``LIBRARIAN_QUIET_LOGGING`` is set (to a
+  non-empty value), the logger is returned untouched. Use this when logging is
+  configured by a parent application.
+
   '''
 
+  if os.environ.get('LIBRARIAN_QUIET_LOGGING'): return logging.getLogger(name)
+
   logger = logging.getLogger(name)
-  formatter = logging.Formatter("%(name)s@%(asctime)s -- %(levelname)s: " \
-      "%(message)s")
+
+  # setting the same level again would needlessly clear logging's level caches
+  level = _LOG_LEVELS.get(verbosity, logging.DEBUG)
+  if logger.level != level: logger.setLevel(level)
+  if getattr(logger, '_librarian_configured', False): return logger
 
   _warn_err = logging.StreamHandler(sys.stderr)
-  _warn_err.setFormatter(formatter)
+  _warn_err.setFormatter(_LOG_FORMATTER)
   _warn_err.setLevel(logging.WARNING)
 
-  class _InfoFilter:
-    def filter(self, record): return record.levelno <= logging.INFO
   _debug_info = logging.StreamHandler(sys.stdout)
-  _debug_info.setFormatter(formatter)
+  _debug_info.setFormatter(_LOG_FORMATTER)
   _debug_info.setLevel(logging.DEBUG)
-  _debug_info.addFilter(_InfoFilter())
+  _debug_info.addFilter(_LOG_INFO_FILTER)
 
   logger.addHandler(_debug_info)
   logger.addHandler(_warn_err)
+  logger._librarian_configured = True
 
+  return logger
 
-  logger.setLevel(logging.ERROR)
-  if verbosity == 1: logger.setLevel(logging.WARNING)
-  elif verbosity == 2: logger.setLevel(logging.INFO)
-  elif verbosity >= 3: logger.setLevel(logging.DEBUG)
 
-  return logger
+_guessit_api = None
 
 
 def guess(filename, fullpath=True):
@@ -112,35 +290,103 @@ def guess(filename, fullpath=True):
   Returns:
 
     dict: A dictionary containing the parts of the movie or TV show
-    filename/path that was parsed
+    filename/path that was parsed. Results are cached, so each call returns
+    a fresh copy the caller may modify
 
   '''
 
+  filename = os.fspath(filename)
   if not fullpath:
     filename = os.path.basename(filename)
 
-  return guessit.guessit(filename)
+  return copy.copy(_guess(filename))
+
+
+@functools.lru_cache(maxsize=4096)
+def _guess(filename):
+  '''Runs guessit on a (normalized) filename, see :py:func:`guess`'''
+
+  # guessit is heavy to import: only done on the first guess. The shared API
+  # instance then builds its matching rules once, and reuses them
+  global _guessit_api
+  if _guessit_api is None:
+    from guessit.api import default_api as _guessit_api
+
+  return _guessit_api.guessit(filename)
+
+
+# file extensions of video containers we know about
+VIDEO_CONTAINERS = frozenset(('mkv', 'mp4', 'm4v', 'avi', 'mov', 'wmv', 'flv',
+  'webm', 'ts'))
+
+
+def quick_container(filename):
+  '''Returns the video container of a file, judging by its extension only
+
+  This is a cheap alternative to :py:func:`guess` for callers only interested
+  in the ``container`` entry.
+
+
+  Parameters:
+
+    filename (str): The name of the file, including, possibly, its fullpath
+
+
+  Returns:
+
+    str: The lower-cased container extension (e.g. ``mkv``), without the dot,
+    or ``None`` if the extension is not one of :py:data:`VIDEO_CONTAINERS`
+
+  '''
+
+  ext = os.path.splitext(os.fspath(filename))[1][1:].lower()
+  return ext if ext in VIDEO_CONTAINERS else None
+
+
+def is_video(filename):
+  '''Tells if a file is a video, judging by its extension only'''
+
+  return quick_container(filename) is not None
+
+
+def guess_many(filenames, fullpath=True):
+  '''Guesses movie or TV show information for many files at once
+
+  All files are guessed with the same guessit API instance, so its matching
+  rules are only built once for the whole batch.
+
+
+  Parameters:
+
+    filenames (list): The names of the files being guessed, including,
+      possibly, their fullpath
+
+    fullpath (:py:obj:`bool`, optional): If set, the names will be guessed
+      using the full path leading to each file
+
+
+  Returns:
+
+    list: A list of dictionaries, one per file, in the same order as
+    ``filenames``, as returned by :py:func:`guess`
+
+  '''
+
+  return [guess(k, fullpath) for k in filenames]
 
 
 def uniq(seq, idfun=None):
   """Very fast, order preserving uniq function"""
 
-  # order preserving
-  if idfun is None:
-      def idfun(x): return x
+  # order preserving: dictionaries keep insertion order
+  if idfun is None: return list(dict.fromkeys(seq))
+
   seen = {}
-  result = []
-  for item in seq:
-      marker = idfun(item)
-      # in old Python versions:
-      # if seen.has_key(marker)
-      # but in new ones:
-      if marker in seen: continue
-      seen[marker] = 1
-      result.append(item)
-  return result
+  for item in seq: seen.setdefault(idfun(item), item) #keeps the first
+  return list(seen.values())
 
 
+@functools.lru_cache(maxsize=128)
 def as_language(l):
   '''Converts the language string into a :py:class:`babelfish.Language` object
 
@@ -198,6 +444,14 @@ def language_acronyms(l):
 
   '''
 
+  # the cached tuple is copied, so callers may freely modify their list
+  return list(_language_acronyms(l))
+
+
+@functools.lru_cache(maxsize=128)
+def _language_acronyms(l):
+  '''Computes the language acronyms returned by :py:func:`language_acronyms`'''
+
   retval = []
   if l.country is not None:
     a22 = l.alpha2 + '-' + l.country.alpha2
@@ -209,4 +463,4 @@ def language_acronyms(l):
         ]
 
   # these are more generic, so go last
-  return uniq(retval + [l.alpha2, l.alpha3b, l.alpha3])
+  return tuple(uniq(retval + [l.alpha2, l.alpha3b, l.alpha3]))
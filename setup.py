@@ -3,6 +3,9 @@
 
 from setuptools import setup, find_packages
 
+with open('README.rst', encoding='utf-8') as f:
+  long_description = f.read()
+
 setup(
 
     name='librarian',
@@ -12,7 +15,7 @@ setup(
     license="GPLv3",
     author='Andre Anjos',
     author_email='andre.dos.anjos@gmail.com',
-    long_description=open('README.rst').read(),
+    long_description=long_description,
 
     packages=find_packages(),
     include_package_data=True,
@@ -20,7 +23,6 @@ setup(
 
     install_requires=[
       'setuptools',
-      'six',
       'docopt',
       'guessit',
       'subliminal',
@@ -29,9 +31,10 @@ setup(
       'pytvdbapi',
       'pexpect',
       'tqdm',
-      'chardet',
-      'babelfish',
+      'chardet<6',
+      'babelfish<0.7',
       'pysrt',
+      'requests',
       ],
 
     entry_points = {